@@ -1,13 +1,131 @@
 #!/usr/bin/env python3
 
+import io
+import os
+import itertools
+import math
 import json
+import collections
+import multiprocessing
 import warnings
 import random
+import time
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from tqdm import tqdm
-from PIL import Image, ImageEnhance
+from PIL import Image
+
+try:
+    from numba import njit, prange, set_num_threads
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    TURBOJPEG = TurboJPEG() # carga libturbojpeg; falla si la biblioteca no está instalada
+except (ImportError, RuntimeError, OSError):
+    TURBOJPEG = None
+
+try:
+    import cv2
+    CV2_AVAILABLE = True
+except ImportError:
+    CV2_AVAILABLE = False
+
+try:
+    from liburing import (Ring, Cqe, io_uring_queue_init, io_uring_queue_exit, io_uring_get_sqe,
+                          io_uring_prep_write, io_uring_sqe_set_data64, io_uring_submit,
+                          io_uring_wait_cqe, io_uring_cqe_seen, trap_error)
+    LIBURING_AVAILABLE = True
+except ImportError:
+    LIBURING_AVAILABLE = False
+
+def _blend_fg(comp, comp_mask, fg_rgba, py, px, cr, cg, cb, thr):
+    """ Mezcla un foreground RGBA sobre la composición y su máscara, in-place.
+    Args:
+        comp: composición uint8 HxWx3
+        comp_mask: máscara uint8 HxWx3
+        fg_rgba: foreground uint8 fhxfwx4
+        py, px: posición (fila, columna) donde se pega el foreground
+        cr, cg, cb: color rgb de la máscara del foreground
+        thr: umbral de alpha para la máscara
+    """
+    fh, fw = fg_rgba.shape[0], fg_rgba.shape[1]
+    for y in prange(fh):
+        for x in range(fw):
+            a = np.int32(fg_rgba[y, x, 3])
+            if a == 0:
+                continue
+            Y = py + y
+            X = px + x
+            inv = 255 - a
+            for c in range(3):
+                comp[Y, X, c] = (np.int32(fg_rgba[y, x, c]) * a + np.int32(comp[Y, X, c]) * inv + 127) // 255
+            if a > thr:
+                comp_mask[Y, X, 0] = cr
+                comp_mask[Y, X, 1] = cg
+                comp_mask[Y, X, 2] = cb
+
+if NUMBA_AVAILABLE:
+    _blend_fg = njit(parallel=True, fastmath=True, cache=True)(_blend_fg)
+
+def _cpu_count():
+    # os.cpu_count() puede devolver None si no se puede determinar
+    return os.cpu_count() or 1
+
+class _ByteBudgetLRU():
+    """ Caché LRU de este proceso, acotada en bytes.
+    """
+
+    def __init__(self):
+        self.items = collections.OrderedDict() # key -> (valor, bytes), del menos al más usado
+        self.total_bytes = 0
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        self.items.move_to_end(key)
+        return item[0]
+
+    def put(self, key, value, nbytes, budget_bytes):
+        """ Guarda value y descarta los menos usados hasta entrar en budget_bytes (siempre se queda value)
+        """
+        self.items[key] = (value, nbytes)
+        self.total_bytes += nbytes
+        while len(self.items) > 1 and self.total_bytes > budget_bytes:
+            _, (_, evicted_bytes) = self.items.popitem(last=False)
+            self.total_bytes -= evicted_bytes
+
+# Fondos y foregrounds decodificados en este proceso (ver ImageComposition._load_background/_load_foreground)
+_background_cache = _ByteBudgetLRU()
+_foreground_cache = _ByteBudgetLRU()
+
+# ImageComposition de cada proceso del pool (ver _init_worker)
+_worker_image_comp = None
+
+def _init_worker(image_comp):
+    """ Inicializa un proceso del pool con la configuración ya validada.
+    Args:
+        image_comp: ImageComposition con args, foregrounds y backgrounds procesados
+    """
+    global _worker_image_comp
+    _worker_image_comp = image_comp
+    if NUMBA_AVAILABLE:
+        # El paralelismo ya está en los procesos, evitamos sobre-suscribir hilos
+        set_num_threads(1)
+
+def _compose_one(i):
+    return _worker_image_comp._generate_image(i)
 
 class MaskJsonUtils():
     """ Creamos un achivo de definición JSON para las máscara.
@@ -77,28 +195,114 @@ class MaskJsonUtils():
         """
         return self.masks
 
-    def get_super_categories(self):
-        """ Un diccionario de las listas de categorías en una super-categoría
-        """
-        serializable_super_cats = dict()
-        for super_cat, categories_set in self.super_categories.items():
-            # Convertimos a lista porque los sets no son serializables
-            serializable_super_cats[super_cat] = list(categories_set)
-        return serializable_super_cats
-
     def write_masks_to_json(self):
-        # Serializamos máscaras y categorías
-        serializable_masks = self.get_masks()
-        serializable_super_cats = self.get_super_categories()
+        # Serializamos máscaras y categorías; los sets se convierten a lista al vuelo con default=list
         masks_obj = {
-            'masks': serializable_masks,
-            'super_categories': serializable_super_cats
+            'masks': self.get_masks(),
+            'super_categories': self.super_categories
         }
 
         # JSON de salida
         output_file_path = Path(self.output_dir) / 'mascaras.json'
-        with open(output_file_path, 'w+') as json_file:
-            json_file.write(json.dumps(masks_obj))
+        if ORJSON_AVAILABLE:
+            with open(output_file_path, 'wb') as json_file:
+                json_file.write(orjson.dumps(masks_obj, default=list))
+        else:
+            with open(output_file_path, 'w+') as json_file:
+                json_file.write(json.dumps(masks_obj, default=list))
+
+class UringWriter():
+    """ Escribe archivos ya codificados en lotes a través de io_uring.
+    """
+
+    def __init__(self, queue_depth=64, batch_size=32):
+        """ Inicializamos el ring.
+        Args:
+            queue_depth: número de entradas de la cola de envío
+            batch_size: escrituras acumuladas antes de enviar y cosechar el lote
+        """
+        assert batch_size <= queue_depth, 'batch_size debe ser <= queue_depth'
+        self.batch_size = batch_size
+        self.ring = Ring()
+        self.cqe = Cqe()
+        io_uring_queue_init(queue_depth, self.ring)
+        self.pending = dict() # op id -> (fd, buffer, path); mantiene vivo el buffer hasta el CQE
+        self.next_op_id = 0
+
+    def write(self, path, data):
+        """ Encola la escritura de data (bytes) en path
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        op_id = self.next_op_id
+        self.next_op_id += 1
+
+        sqe = io_uring_get_sqe(self.ring)
+        io_uring_prep_write(sqe, fd, data, 0)
+        io_uring_sqe_set_data64(sqe, op_id)
+        self.pending[op_id] = (fd, data, path)
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Envía las escrituras encoladas y espera a que todas terminen
+        """
+        if not self.pending:
+            return
+
+        # Cosechamos todo el lote (y cerramos todos los fd) antes de propagar el primer error
+        errors = []
+        io_uring_submit(self.ring)
+        while self.pending:
+            io_uring_wait_cqe(self.ring, self.cqe)
+            cqe = self.cqe[0]
+            fd, data, path = self.pending.pop(cqe.user_data)
+            try:
+                # cqe.res ya lanza OSError si la escritura falló
+                written = trap_error(cqe.res)
+                # Escritura parcial: completamos el resto de forma síncrona
+                while written < len(data):
+                    written += os.pwrite(fd, data[written:], written)
+            except OSError as e:
+                errors.append(e)
+            finally:
+                io_uring_cqe_seen(self.ring, cqe)
+                os.close(fd)
+
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            io_uring_queue_exit(self.ring)
+
+def _save_image(image, path):
+    _write_file(*_encode_file(image, path))
+
+def _write_file(path, data):
+    with open(path, 'wb') as image_file:
+        image_file.write(data)
+
+def _encode_file(image, path):
+    return path, _encode_image(image, Path(path).suffix)
+
+def _encode_image(image, suffix):
+    """ Codifica una imagen PIL RGB en memoria con el formato de la extensión (e.g. '.jpg').
+    Usa libjpeg-turbo (PyTurboJPEG) para JPEG y OpenCV para PNG si están instalados; si no, PIL
+    """
+    if suffix in ('.jpg', '.jpeg') and TURBOJPEG is not None:
+        # Misma calidad y submuestreo que el default de PIL
+        return TURBOJPEG.encode(np.asarray(image), quality=75, pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420)
+    if suffix == '.png' and CV2_AVAILABLE:
+        success, buffer = cv2.imencode('.png', np.asarray(image)[:, :, ::-1], [cv2.IMWRITE_PNG_COMPRESSION, 3])
+        assert success, 'no se pudo codificar el png'
+        return buffer.tobytes()
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=Image.registered_extensions()[suffix])
+    return buffer.getvalue()
 
 class ImageComposition():
     """ Hacemos la composición de forma random, aplicando transformaciones la los foregrounss para crear
@@ -112,6 +316,26 @@ class ImageComposition():
         self.max_foregrounds = 3
         self.mask_colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
         assert len(self.mask_colors) >= self.max_foregrounds, 'longitud de los colores de las mascaras >= max_foregrounds'
+        self.background_cache_mb = 1024 # memoria total para fondos decodificados, entre todos los procesos
+        self.foreground_cache_mb = 512 # memoria total para foregrounds decodificados, entre todos los procesos
+
+        if NUMBA_AVAILABLE:
+            # Compilamos el kernel una vez, fuera del loop de tqdm
+            dummy_fg = np.zeros((1, 1, 4), dtype=np.uint8)
+            dummy_fg.setflags(write=False) # np.asarray(PIL) es de solo lectura
+            _blend_fg(np.zeros((1, 1, 3), np.uint8), np.zeros((1, 1, 3), np.uint8), dummy_fg, 0, 0, 0, 0, 0, 200)
+
+        # Pool de hilos para guardar imágenes, solo en el proceso principal (ver _generate_images)
+        self._io_pool = None
+        self._pending_saves = collections.deque()
+        self._max_pending_saves = 0
+        self._uring_writer = None
+
+        # Tiempos por fase ({'blend': [...], 'encode': [...], 'write': [...]}) mientras se perfila, si no None
+        self.profile_count = 5
+        self._phase_times = None
+        # Coste estimado de arrancar el pool (spawn: importar numpy/numba y recibir self), en segundos
+        self.pool_startup_s = 1.0
 
     def _validate_and_process_args(self, args):
 
@@ -127,6 +351,20 @@ class ImageComposition():
         assert args.height >= 64, 'altura tiene que ser mayor que 64'
         self.height = args.height
 
+        # Validamos procesos y semilla
+        # Sin --workers ni --io-uring se elige el pipeline midiendo las primeras imágenes
+        self.auto_pipeline = args.workers is None and not args.io_uring
+        self.workers = args.workers if args.workers is not None else 1
+        assert self.workers > 0, 'workers debe ser mayor que 0'
+        self.seed = args.seed if args.seed is not None else random.randrange(2**32)
+
+        # Validamos el ajuste de rotación a múltiplos de 90 grados
+        self.snap_rotation = args.snap_rotation
+        assert 0 <= self.snap_rotation < 45, 'snap_rotation debe estar entre 0 y 44'
+
+        self.io_uring = args.io_uring
+        assert not self.io_uring or LIBURING_AVAILABLE, '--io-uring requiere el paquete liburing'
+
         # Validamos y pricesamos el formato de salida
         if args.output_type is None:
             self.output_type = '.jpg' # default
@@ -135,6 +373,10 @@ class ImageComposition():
                 self.output_type = f'.{args.output_type}'
             assert self.output_type in self.allowed_output_types, f'output_type is not supported: {self.output_type}'
 
+        # Buffers de la composición, reutilizados en cada imagen (Image.fromarray copia al salir)
+        self._comp_canvas = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        self._mask_canvas = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+
         # Validamos directorios de entrada y salida
         self._validate_and_process_output_directory()
         self._validate_and_process_input_directory()
@@ -218,6 +460,19 @@ class ImageComposition():
 
         assert len(self.foregrounds_dict) > 0, 'no se encontraron foregrouns validos'
 
+        # Lista plana (super_category, category, path) para muestrear todos los foregrounds de una
+        # imagen con un solo random.choices. Los pesos conservan el muestreo jerárquico uniforme:
+        # super-categoría, luego categoría, luego imagen
+        self._fg_flat = []
+        fg_weights = []
+        for super_category, categories in self.foregrounds_dict.items():
+            for category, paths in categories.items():
+                weight = 1.0 / (len(self.foregrounds_dict) * len(categories) * len(paths))
+                for path in paths:
+                    self._fg_flat.append((super_category, category, path))
+                    fg_weights.append(weight)
+        self._fg_cum_weights = list(itertools.accumulate(fg_weights))
+
     def _validate_and_process_backgrounds(self):
         self.backgrounds = []
         for image_file in self.backgrounds_dir.iterdir():
@@ -242,81 +497,226 @@ class ImageComposition():
 
         mju = MaskJsonUtils(self.output_dir)
 
-        # Creamos todas las imágenes/máscaras (with tqdm to have a progress bar)
-        for i in tqdm(range(self.count)):
-            # escogemos un fondo
-            background_path = random.choice(self.backgrounds)
-
-            num_foregrounds = random.randint(1, self.max_foregrounds)
-            foregrounds = []
-            for fg_i in range(num_foregrounds):
-                # Randomly choose a foreground
-                super_category = random.choice(list(self.foregrounds_dict.keys()))
-                category = random.choice(list(self.foregrounds_dict[super_category].keys()))
-                foreground_path = random.choice(self.foregrounds_dict[super_category][category])
-
-                # Get the color
-                mask_rgb_color = self.mask_colors[fg_i]
-
-                foregrounds.append({
-                    'super_category':super_category,
-                    'category':category,
-                    'foreground_path':foreground_path,
-                    'mask_rgb_color':mask_rgb_color
-                })
-
-            # Composición
-            composite, mask = self._compose_images(foregrounds, background_path)
+        # Las primeras imágenes se generan en serie midiendo cada fase, y con eso elegimos el pipeline
+        first_results = []
+        if self.auto_pipeline:
+            first_results = self._profile_and_choose_pipeline()
 
-            save_filename = f'{i:0{self.zero_padding}}' # e.g. 00000023.jpg
+        # Con io_uring las imágenes se codifican (en los procesos o en el pool de hilos) y aquí se
+        # escriben en lote
+        writer = UringWriter() if self.io_uring else None
 
+        # Creamos todas las imágenes/máscaras (with tqdm to have a progress bar)
+        if self.workers > 1:
+            # Cada imagen es independiente: repartimos el trabajo entre procesos.
+            # Usamos 'spawn' porque los hilos de numba (tbb/omp) no sobreviven a un fork
+            mp_context = multiprocessing.get_context('spawn')
+            executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=mp_context,
+                                           initializer=_init_worker, initargs=(self,))
+            # Bloques pequeños si quedan pocas imágenes, para que todos los procesos reciban trabajo
+            remaining = self.count - len(first_results)
+            chunksize = max(1, min(16, remaining // (4 * self.workers)))
+            results = executor.map(_compose_one, range(len(first_results), self.count), chunksize=chunksize)
+        else:
+            executor = None
+            results = map(self._generate_image, range(len(first_results), self.count))
+            # En un solo proceso solapamos la codificación (y escritura, si no hay io_uring) con la
+            # siguiente imagen (PIL libera el GIL mientras codifica JPEG/PNG)
+            io_workers = min(8, _cpu_count())
+            self._io_pool = ThreadPoolExecutor(max_workers=io_workers)
+            self._max_pending_saves = 2 * io_workers
+            self._uring_writer = writer
+
+        try:
+            # El acumulador del JSON se llena en el proceso principal
+            for composite_rel, mask_rel, color_categories, encoded_files in tqdm(itertools.chain(first_results, results), total=self.count):
+                for path, data in encoded_files:
+                    writer.write(path, data)
+                mju.add_mask(composite_rel, mask_rel, color_categories)
+
+            # Esperamos las escrituras pendientes (y propagamos sus errores)
+            while self._pending_saves:
+                self._finish_save(self._pending_saves.popleft())
+        except BaseException:
+            # Ante un error (o Ctrl-C) no esperamos a las imágenes que siguen en la cola del pool
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            # Un fallo al vaciar el writer no debe tapar el error original
+            if writer is not None:
+                try:
+                    writer.close()
+                except OSError:
+                    pass
+                writer = None
+            raise
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if self._io_pool is not None:
+                self._io_pool.shutdown(cancel_futures=True)
+                self._io_pool = None
+            self._pending_saves.clear()
+            self._uring_writer = None
+            if writer is not None:
+                writer.close()
 
-            composite_filename = f'{save_filename}{self.output_type}' # e.g. 00000023.jpg
-            composite_path = self.output_dir / 'images' / composite_filename # e.g. mi_output_dir/images/00000023.jpg
-            composite = composite.convert('RGB') # remove alpha
-            composite.save(composite_path)
-
+        mju.write_masks_to_json()
 
-            mask_filename = f'{save_filename}.png' #simpre png
-            mask_path = self.output_dir / 'masks' / mask_filename # e.g. my_output_dir/masks/00000023.png
-            mask.save(mask_path)
+    def _profile_and_choose_pipeline(self):
+        """ Genera las primeras imágenes en serie midiendo composición, codificación y escritura, y elige
+        el pipeline: procesos si domina el trabajo de CPU (componer + codificar) y queda suficiente para
+        amortizar el arranque del pool, un solo proceso con io_uring (o hilos) en otro caso
+        Returns:
+            los resultados de _generate_image de las imágenes ya generadas
+        """
+        self._phase_times = {'blend': [], 'encode': [], 'write': []}
+        first_results = [self._generate_image(i) for i in range(min(self.profile_count, self.count))]
+        blend_time, encode_time, write_time = (sum(times) / len(times) for times in self._phase_times.values())
+        self._phase_times = None
 
-            color_categories = dict()
-            for fg in foregrounds:
+        io_bound = write_time > blend_time + encode_time
+        self.io_uring = LIBURING_AVAILABLE and io_bound
 
-                mju.add_category(fg['category'], fg['super_category'])
-                color_categories[str(fg['mask_rgb_color'])] = \
-                    {
-                        'category':fg['category'],
-                        'super_category':fg['super_category']
-                    }
+        # El pool solo compensa si el tiempo de CPU que ahorra supera con holgura lo que cuesta arrancarlo
+        workers = _cpu_count()
+        remaining_cpu_time = (self.count - len(first_results)) * (blend_time + encode_time)
+        saved_time = remaining_cpu_time * (1 - 1 / workers)
+        use_pool = not io_bound and saved_time > 2 * self.pool_startup_s
+        self.workers = workers if use_pool else 1
 
+        if not self.silent:
+            print(f'Composición {blend_time * 1000:.1f} ms, codificación {encode_time * 1000:.1f} ms, '
+                  f'escritura {write_time * 1000:.1f} ms por imagen: workers={self.workers}, io_uring={self.io_uring}')
 
-            mju.add_mask(
-                composite_path.relative_to(self.output_dir).as_posix(),
-                mask_path.relative_to(self.output_dir).as_posix(),
-                color_categories
-            )
+        return first_results
 
+    def _generate_image(self, i):
+        """ Compone y guarda la imagen número i con su máscara
+        Args:
+            i: índice de la imagen, usado para el nombre de archivo y la semilla
+        Returns:
+            (path relativo de la imagen, path relativo de la máscara, color_categories,
+             lista de (path, bytes) por escribir si se usa io_uring desde un proceso del pool)
+        """
+        # Semilla por imagen para que el resultado no dependa del número de procesos
+        random.seed(self.seed + i)
+
+        # escogemos un fondo
+        background_path = random.choice(self.backgrounds)
+
+        num_foregrounds = random.randint(1, self.max_foregrounds)
+        foregrounds = []
+        # Randomly choose the foregrounds
+        picks = random.choices(self._fg_flat, cum_weights=self._fg_cum_weights, k=num_foregrounds)
+        for fg_i, (super_category, category, foreground_path) in enumerate(picks):
+            # Get the color
+            mask_rgb_color = self.mask_colors[fg_i]
+
+            foregrounds.append({
+                'super_category':super_category,
+                'category':category,
+                'foreground_path':foreground_path,
+                'mask_rgb_color':mask_rgb_color
+            })
+
+        # Composición
+        if self._phase_times is not None:
+            # Pasada previa sin medir: la decodificación de fondos y foregrounds se cachea para el resto
+            # del run y no debe contar como composición. Restauramos el estado random para repetir la misma
+            random_state = random.getstate()
+            self._compose_images(foregrounds, background_path)
+            random.setstate(random_state)
+
+        start_time = time.perf_counter()
+        composite, mask = self._compose_images(foregrounds, background_path)
+        blend_end_time = time.perf_counter()
+
+        save_filename = f'{i:0{self.zero_padding}}' # e.g. 00000023.jpg
+
+
+        composite_filename = f'{save_filename}{self.output_type}' # e.g. 00000023.jpg
+        composite_path = self.output_dir / 'images' / composite_filename # e.g. mi_output_dir/images/00000023.jpg
+        composite = composite.convert('RGB') # remove alpha
+
+        mask_filename = f'{save_filename}.png' #simpre png
+        mask_path = self.output_dir / 'masks' / mask_filename # e.g. my_output_dir/masks/00000023.png
+
+        encoded_files = []
+        if self._io_pool is not None and self.io_uring:
+            # Codificamos en el pool de hilos; la escritura la hace el UringWriter (ver _finish_save)
+            self._submit_save(_encode_file, composite, composite_path)
+            self._submit_save(_encode_file, mask, mask_path)
+        elif self._io_pool is not None:
+            self._submit_save(_save_image, composite, composite_path)
+            self._submit_save(_save_image, mask, mask_path)
+        elif self.io_uring:
+            # Proceso del pool: solo codificamos; la escritura la hace el UringWriter del proceso principal
+            encoded_files.append((composite_path, _encode_image(composite, self.output_type)))
+            encoded_files.append((mask_path, _encode_image(mask, '.png')))
+        else:
+            # Codificamos y escribimos por separado para poder medir cada fase al perfilar
+            files = [_encode_file(composite, composite_path), _encode_file(mask, mask_path)]
+            encode_end_time = time.perf_counter()
+            for path, data in files:
+                _write_file(path, data)
+
+            if self._phase_times is not None:
+                self._phase_times['blend'].append(blend_end_time - start_time)
+                self._phase_times['encode'].append(encode_end_time - blend_end_time)
+                self._phase_times['write'].append(time.perf_counter() - encode_end_time)
+
+        color_categories = dict()
+        for fg in foregrounds:
+            color_categories[str(fg['mask_rgb_color'])] = \
+                {
+                    'category':fg['category'],
+                    'super_category':fg['super_category']
+                }
+
+        return (
+            composite_path.relative_to(self.output_dir).as_posix(),
+            mask_path.relative_to(self.output_dir).as_posix(),
+            color_categories,
+            encoded_files
+        )
+
+    def _submit_save(self, fn, *args):
+        """ Encola un guardado en el pool de hilos con a lo sumo _max_pending_saves en vuelo, para no
+        acumular imágenes en memoria si codificar es más lento que componer
+        """
+        # Descartamos los ya terminados (propagando sus errores) y esperamos al más viejo si hay demasiados
+        while self._pending_saves and (self._pending_saves[0].done() or len(self._pending_saves) >= self._max_pending_saves):
+            self._finish_save(self._pending_saves.popleft())
+        self._pending_saves.append(self._io_pool.submit(fn, *args))
 
-        mju.write_masks_to_json()
+    def _finish_save(self, future):
+        """ Espera un guardado del pool (propagando sus errores); si solo codificó, escribe vía io_uring
+        """
+        encoded_file = future.result()
+        if encoded_file is not None:
+            self._uring_writer.write(*encoded_file)
 
     def _compose_images(self, foregrounds, background_path):
 
-        # Abrimos fondo y convertimos a RGBA
-        background = Image.open(background_path)
-        background = background.convert('RGBA')
+        # Fondo ya decodificado (se cachea por path)
+        background = self._load_background(str(background_path))
 
         # REcortamos fondo (self.width x self.height)
-        bg_width, bg_height = background.size
+        bg_height, bg_width = background.shape[:2]
         max_crop_x_pos = bg_width - self.width
         max_crop_y_pos = bg_height - self.height
         assert max_crop_x_pos >= 0, f'achira deseada, {self.width}, mayor que ancho de fondo, {bg_width}, for {str(background_path)}'
         assert max_crop_y_pos >= 0, f'altura deseada, {self.height}, mayor que alto de fondo, {bg_height}, for {str(background_path)}'
         crop_x_pos = random.randint(0, max_crop_x_pos)
         crop_y_pos = random.randint(0, max_crop_y_pos)
-        composite = background.crop((crop_x_pos, crop_y_pos, crop_x_pos + self.width, crop_y_pos + self.height))
-        composite_mask = Image.new('RGB', composite.size, 0)
+        background_crop = background[crop_y_pos:crop_y_pos + self.height, crop_x_pos:crop_x_pos + self.width]
+
+        # Trabajamos la composición sobre los arreglos uint8 (HxWx3) reutilizados y solo volvemos a PIL al final
+        composite = self._comp_canvas
+        composite[...] = background_crop
+        composite_mask = self._mask_canvas
+        composite_mask.fill(0)
+        alpha_threshold = 200
 
         for fg in foregrounds:
             fg_path = fg['foreground_path']
@@ -325,63 +725,154 @@ class ImageComposition():
             fg_image = self._transform_foreground(fg, fg_path)
 
             # Escogemos posición al azar
-            max_x_position = composite.size[0] - fg_image.size[0]
-            max_y_position = composite.size[1] - fg_image.size[1]
+            max_x_position = self.width - fg_image.size[0]
+            max_y_position = self.height - fg_image.size[1]
             assert max_x_position >= 0 and max_y_position >= 0, \
             f'foreground {fg_path} es demasiado grande ({fg_image.size[0]}x{fg_image.size[1]}) para la salida requerida ({self.width}x{self.height}), revisar parámetros de entrada'
             paste_position = (random.randint(0, max_x_position), random.randint(0, max_y_position))
 
-            # Create a new foreground image as large as the composite and paste it on top
-            new_fg_image = Image.new('RGBA', composite.size, color = (0, 0, 0, 0))
-            new_fg_image.paste(fg_image, paste_position)
+            fg_arr = np.asarray(fg_image)
+            paste_x, paste_y = paste_position
+            mask_rgb_color = fg['mask_rgb_color']
+
+            if NUMBA_AVAILABLE:
+                _blend_fg(composite, composite_mask, fg_arr, paste_y, paste_x, *mask_rgb_color, alpha_threshold)
+                continue
 
-            # Alpha
-            alpha_mask = fg_image.getchannel(3)
-            new_alpha_mask = Image.new('L', composite.size, color = 0)
-            new_alpha_mask.paste(alpha_mask, paste_position)
-            composite = Image.composite(new_fg_image, composite, new_alpha_mask)
+            # Fuera del rectángulo pegado el alpha es 0: solo trabajamos sobre esa región
+            fg_height, fg_width = fg_arr.shape[:2]
+            region = (slice(paste_y, paste_y + fg_height), slice(paste_x, paste_x + fg_width))
 
-            alpha_threshold = 200
-            mask_arr = np.array(np.greater(np.array(new_alpha_mask), alpha_threshold), dtype=np.uint8)
-            uint8_mask = np.uint8(mask_arr) # This is composed of 1s and 0s
+            # Alpha blending con enteros: (fg*a + bg*(255-a)) / 255
+            alpha = fg_arr[:, :, 3:4].astype(np.uint16)
+            composite[region] = (fg_arr[:, :, :3] * alpha + composite[region] * (255 - alpha) + 127) // 255
 
-            mask_rgb_color = fg['mask_rgb_color']
-            red_channel = uint8_mask * mask_rgb_color[0]
-            green_channel = uint8_mask * mask_rgb_color[1]
-            blue_channel = uint8_mask * mask_rgb_color[2]
-            rgb_mask_arr = np.dstack((red_channel, green_channel, blue_channel))
-            isolated_mask = Image.fromarray(rgb_mask_arr, 'RGB')
-            isolated_alpha = Image.fromarray(uint8_mask * 255, 'L')
+            # Umbral sobre el alpha del foreground y asignación directa del color
+            fg_mask = fg_arr[:, :, 3] > alpha_threshold
+            composite_mask[region][fg_mask] = mask_rgb_color
 
-            composite_mask = Image.composite(isolated_mask, composite_mask, isolated_alpha)
+        return Image.fromarray(composite, 'RGB'), Image.fromarray(composite_mask, 'RGB')
 
-        return composite, composite_mask
+    def _load_background(self, path_str):
+        """ Decodifica un fondo y lo devuelve como arreglo uint8 HxWx3 de solo lectura. Se guardan los
+        usados más recientemente hasta background_cache_mb, repartidos entre los procesos del pool
+        """
+        background = _background_cache.get(path_str)
+        if background is None:
+            background = np.array(Image.open(path_str).convert('RGB'))
+            background.setflags(write=False)
+            _background_cache.put(path_str, background, background.nbytes,
+                                  self.background_cache_mb * 2**20 // self.workers)
+        return background
+
+    def _load_foreground(self, path_str):
+        """ Decodifica un foreground (las transformaciones siempre devuelven una copia). Se guardan los
+        usados más recientemente hasta foreground_cache_mb, repartidos entre los procesos del pool
+        """
+        fg_image = _foreground_cache.get(path_str)
+        if fg_image is None:
+            fg_image = Image.open(path_str)
+            fg_image.load()
+            fg_alpha = np.array(fg_image.getchannel(3))
+            assert np.any(fg_alpha == 0), f'foreground needs to have some transparency: {path_str}'
+            fg_bytes = fg_image.size[0] * fg_image.size[1] * len(fg_image.getbands())
+            _foreground_cache.put(path_str, fg_image, fg_bytes, self.foreground_cache_mb * 2**20 // self.workers)
+        return fg_image
 
     def _transform_foreground(self, fg, fg_path):
 
-        fg_image = Image.open(fg_path)
-        fg_alpha = np.array(fg_image.getchannel(3))
-        assert np.any(fg_alpha == 0), f'foreground needs to have some transparency: {str(fg_path)}'
+        fg_image = self._load_foreground(str(fg_path))
 
         # ** Aplicamos transformaciones **
-        # Rotamosforeground
+        # Rotamos y escalamos el foreground en un solo remuestreo BICUBIC
         angle_degrees = random.randint(0, 359)
-        fg_image = fg_image.rotate(angle_degrees, resample=Image.BICUBIC, expand=True)
-
-        # Escalamos el foreground
         scale = random.random() * .5 + .5 # Pick something between .5 and 1
-        new_size = (int(fg_image.size[0] * scale), int(fg_image.size[1] * scale))
-        fg_image = fg_image.resize(new_size, resample=Image.BICUBIC)
+
+        # Múltiplos de 90 (o ángulos a --snap-rotation grados de uno) no necesitan remuestrear la rotación
+        right_angle = 90 * round(angle_degrees / 90)
+        if abs(angle_degrees - right_angle) <= self.snap_rotation:
+            fg_image = self._rotate_right_angle_and_scale(fg_image, right_angle % 360, scale)
+        else:
+            fg_image = self._rotate_and_scale(fg_image, angle_degrees, scale)
 
         # Ajustamos brillos
         brightness_factor = random.random() * .4 + .7 # Pick something between .7 and 1.1
-        enhancer = ImageEnhance.Brightness(fg_image)
-        fg_image = enhancer.enhance(brightness_factor)
+        fg_image = self._adjust_brightness(fg_image, brightness_factor)
 
         # Añadimos transformaciones aquí...
 
         return fg_image
 
+    @staticmethod
+    def _rotate_and_scale(image, angle_degrees, scale):
+        """ Rota como image.rotate(angle, expand=True) y escala a int(tamaño * scale) con una sola
+        transformación afín (un remuestreo y una imagen nueva en lugar de dos). Con scale=1 el
+        resultado es idéntico a Image.rotate; al reducir no se aplica el filtro antialias de resize,
+        así que los bordes quedan algo más nítidos
+        Args:
+            image: imagen PIL
+            angle_degrees: ángulo en grados, en sentido antihorario (como Image.rotate)
+            scale: factor de escala
+        """
+        if angle_degrees % 90 == 0:
+            # Image.rotate tampoco remuestrea en múltiplos de 90: copia o transpose
+            return ImageComposition._rotate_right_angle_and_scale(image, angle_degrees % 360, scale)
+
+        width, height = image.size
+
+        # Matriz inversa de la rotación construida igual que Image.rotate: alrededor del centro...
+        angle = -math.radians(angle_degrees)
+        a, b = round(math.cos(angle), 15), round(math.sin(angle), 15)
+        d, e = round(-math.sin(angle), 15), round(math.cos(angle), 15)
+        center_x, center_y = width / 2, height / 2
+        c = a * -center_x + b * -center_y + center_x
+        f = d * -center_x + e * -center_y + center_y
+
+        # ...con la caja que contiene la imagen rotada (expand=True)...
+        corners_x, corners_y = [], []
+        for x, y in ((0, 0), (width, 0), (width, height), (0, height)):
+            corners_x.append(a * x + b * y + c)
+            corners_y.append(d * x + e * y + f)
+        rotated_width = math.ceil(max(corners_x)) - math.floor(min(corners_x))
+        rotated_height = math.ceil(max(corners_y)) - math.floor(min(corners_y))
+        shift_x, shift_y = -(rotated_width - width) / 2.0, -(rotated_height - height) / 2.0
+        c, f = a * shift_x + b * shift_y + c, d * shift_x + e * shift_y + f
+
+        # ...y luego la escala, con la misma proporción entre tamaños que usaría resize
+        new_width = max(1, int(rotated_width * scale))
+        new_height = max(1, int(rotated_height * scale))
+        ratio_x, ratio_y = rotated_width / new_width, rotated_height / new_height
+        data = (a * ratio_x, b * ratio_y, c, d * ratio_x, e * ratio_y, f)
+
+        return image.transform((new_width, new_height), Image.AFFINE, data=data, resample=Image.BICUBIC)
+
+    @staticmethod
+    def _rotate_right_angle_and_scale(image, angle_degrees, scale):
+        """ Rotación exacta en un múltiplo de 90 grados con transpose (solo copia pixels) seguida de resize
+        Args:
+            image: imagen PIL
+            angle_degrees: 0, 90, 180 o 270, en sentido antihorario (como Image.rotate)
+            scale: factor de escala
+        """
+        transposes = {90: Image.ROTATE_90, 180: Image.ROTATE_180, 270: Image.ROTATE_270}
+        if angle_degrees in transposes:
+            image = image.transpose(transposes[angle_degrees])
+
+        new_size = (max(1, int(image.size[0] * scale)), max(1, int(image.size[1] * scale)))
+        return image.resize(new_size, resample=Image.BICUBIC)
+
+    @staticmethod
+    def _adjust_brightness(image, factor):
+        """ Equivale a ImageEnhance.Brightness(image).enhance(factor) para RGBA: escala solo
+        los canales RGB (truncando y saturando en 255) y deja el alpha intacto
+        """
+        arr = np.array(image) # copia escribible HxWx4
+        rgb = arr[:, :, :3]
+        rgb_tmp = np.multiply(rgb, np.float32(factor), dtype=np.float32)
+        np.clip(rgb_tmp, 0, 255, out=rgb_tmp)
+        np.copyto(rgb, rgb_tmp, casting='unsafe')
+        return Image.fromarray(arr, 'RGBA')
+
     def _create_info(self):
 
         if self.silent:
@@ -447,6 +938,13 @@ if __name__ == "__main__":
     parser.add_argument("--width", type=int, dest="width", required=True, help="ancho en pixels")
     parser.add_argument("--height", type=int, dest="height", required=True, help="alto en pixels")
     parser.add_argument("--output_type", type=str, dest="output_type", help="png or jpg (default)")
+    parser.add_argument("--workers", type=int, dest="workers", help="número de procesos (default: se elige \
+                        midiendo las primeras imágenes)")
+    parser.add_argument("--seed", type=int, dest="seed", help="semilla para resultados reproducibles")
+    parser.add_argument("--io-uring", action='store_true', dest="io_uring", help="escribe las imágenes en lote \
+                        con io_uring (requiere liburing, solo Linux)")
+    parser.add_argument("--snap-rotation", type=int, dest="snap_rotation", default=0, help="grados de tolerancia \
+                        para ajustar la rotación al múltiplo de 90 más cercano y evitar el remuestreo (default 0)")
     parser.add_argument("--silent", action='store_true', help="modo silencioso, \
                         sobreescribe automáticamente")
 